@@ -1,11 +1,23 @@
 # backend/app/database.py
-from sqlalchemy import create_engine, inspect, text
+from sqlalchemy import Column, DateTime, Integer, MetaData, Table, Text, create_engine, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
 from decimal import Decimal
-from datetime import datetime
-import json
+from datetime import datetime, date
+import atexit
+import functools
+import logging
+import os
+import orjson
+import queue
+import re
+import threading
+import time
 from typing import List, Dict, Any
 
+logger = logging.getLogger(__name__)
+
 DB_USER = "test"
 DB_PASSWORD = "1234"
 DB_HOST = "localhost"
@@ -14,28 +26,98 @@ DB_PORT = "5432"
 def get_database_url(db_name: str) -> str:
     return f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{db_name}"
 
+def get_async_database_url(db_name: str) -> str:
+    return f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{db_name}"
+
+@functools.lru_cache(maxsize=32)
 def get_engine(db_name: str):
-    return create_engine(get_database_url(db_name))
+    """
+    Return a pooled Engine for `db_name`, memoized so every request reuses
+    the same pool instead of paying a fresh connect/auth handshake.
+    """
+    return create_engine(
+        get_database_url(db_name),
+        pool_size=20,
+        max_overflow=10,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        pool_timeout=30,
+        json_serializer=_dumps,
+    )
+
+@functools.lru_cache(maxsize=32)
+def get_async_engine(db_name: str) -> AsyncEngine:
+    """
+    Pooled asyncpg engine for the FastAPI handlers, memoized per db_name.
+    The sync engine above stays around for the CLI scripts and the
+    background history writer.
+    """
+    return create_async_engine(
+        get_async_database_url(db_name),
+        pool_size=20,
+        max_overflow=10,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        pool_timeout=30,
+        json_serializer=_dumps,
+    )
+
+# Schema introspection cache: {db_name: (expiry_ts, schema_dict)}.
+# DDL rarely changes, so re-running the inspector's catalog queries on
+# every request is wasted round-trips.
+SCHEMA_CACHE_TTL = int(os.getenv("SCHEMA_CACHE_TTL", "300"))  # seconds
+_schema_cache: Dict[str, Any] = {}
+
+def invalidate_schema_cache(db_name: str = None):
+    """Drop cached schema info (for one database, or all if db_name is None).
+
+    Call after executing DDL so the next request re-introspects.
+    """
+    if db_name is None:
+        _schema_cache.clear()
+    else:
+        _schema_cache.pop(db_name, None)
 
-def get_db_schema(engine) -> Dict[str, List[Dict[str, Any]]]:
+async def get_db_schema(engine: AsyncEngine) -> Dict[str, List[Dict[str, Any]]]:
     """
     Returns full table schema including:
     name, type, nullable, default
+
+    Results are cached per database with a short TTL so the catalog
+    query doesn't run on every request. Keyed by database name (not the
+    engine URL) so invalidate_schema_cache hits the same entry regardless
+    of which driver's engine populated it.
     """
-    inspector = inspect(engine)
-    schema_info = {}
+    cache_key = engine.url.database
+    cached = _schema_cache.get(cache_key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
 
-    for table_name in inspector.get_table_names():
-        columns = []
-        for col in inspector.get_columns(table_name):
-            columns.append({
-                "name": col["name"],
-                "type": str(col["type"]),      # capture SQL type
-                "nullable": col.get("nullable", True),
-                "default": col.get("default")  # sometimes None
-            })
-        schema_info[table_name] = columns
+    schema_info = await _introspect_schema(engine)
+    _schema_cache[cache_key] = (time.monotonic() + SCHEMA_CACHE_TTL, schema_info)
+    return schema_info
+
+_SCHEMA_QUERY = text(
+    "SELECT table_name, column_name, data_type, is_nullable, column_default "
+    "FROM information_schema.columns "
+    "WHERE table_schema = 'public' "
+    "ORDER BY table_name, ordinal_position"
+)
 
+async def _introspect_schema(engine: AsyncEngine) -> Dict[str, List[Dict[str, Any]]]:
+    # One bulk query against information_schema instead of the inspector's
+    # N+1 catalog queries (one per table).
+    schema_info = {}
+    async with engine.connect() as conn:
+        result = await conn.execute(_SCHEMA_QUERY)
+        for row in result:
+            table_name, column_name, data_type, is_nullable, column_default = row
+            schema_info.setdefault(table_name, []).append({
+                "name": column_name,
+                "type": data_type,
+                "nullable": is_nullable == "YES",
+                "default": column_default  # sometimes None
+            })
     return schema_info
 
 def json_serial(obj):
@@ -45,23 +127,74 @@ def json_serial(obj):
         return obj.isoformat()
     raise TypeError(f"Type {type(obj)} not serializable")
 
-def execute_sql(engine: Engine, sql: str):
-    # Auto-commit using a transaction context
-    with engine.begin() as conn:  # engine.begin() starts a transaction and commits automatically
-        result = conn.execute(text(sql))
+def _dumps(obj) -> str:
+    # orjson serializes datetimes natively and is several times faster
+    # than stdlib json on large mixed payloads; json_serial still covers
+    # Decimal.
+    return orjson.dumps(obj, default=json_serial, option=orjson.OPT_NAIVE_UTC).decode()
+
+def _coerce(v):
+    # Convert DB-only types (Decimal, datetime/date) to JSON-friendly
+    # values directly, instead of round-tripping rows through a JSON
+    # string just to normalize them.
+    if isinstance(v, Decimal):
+        return float(v)
+    if isinstance(v, (datetime, date)):
+        return v.isoformat()
+    return v
+
+# Hard cap on rows returned from a SELECT so a LIMIT-less query can't
+# exhaust memory; callers get a truncation flag instead of an OOM.
+MAX_RESULT_ROWS = 50_000
+STREAM_BATCH_SIZE = 1000
+
+# Row-returning statements: a plain SELECT, a CTE (WITH ... SELECT), or
+# a parenthesized SELECT (e.g. a UNION wrapped in parens), allowing
+# leading -- and /* */ comments before the first keyword.
+_SELECT_RE = re.compile(
+    r"^(?:\s+|--[^\n]*\n?|/\*.*?\*/)*(?:SELECT|WITH|\()",
+    re.IGNORECASE | re.DOTALL,
+)
 
-        # SELECT query → fetch results
-        if sql.strip().lower().startswith("select"):
-            rows = [dict(r._mapping) for r in result.fetchall()]
-            return json.loads(json.dumps(rows, default=str))  # use str for json_serial fallback
+# History keeps a summary of each result, not the payload itself: storing
+# every row of a large SELECT bloats query_history and slows both the
+# insert and later reads.
+HISTORY_RESULT_ROWS = 100
+
+def summarize_result(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Reduce a SELECT result to what history needs: the first
+    HISTORY_RESULT_ROWS rows, the total row count, and an explicit
+    truncation marker when rows were dropped."""
+    summary = {"rows": rows[:HISTORY_RESULT_ROWS], "total": len(rows)}
+    if len(rows) > HISTORY_RESULT_ROWS:
+        summary["truncated"] = True
+    return summary
+
+async def execute_sql(engine: AsyncEngine, sql: str, params: Dict[str, Any] = None):
+    # Auto-commit using a transaction context
+    async with engine.begin() as conn:  # engine.begin() starts a transaction and commits automatically
+        # SELECT query → stream results with a server-side cursor so we
+        # never hold the driver's full result set alongside our row dicts
+        if _SELECT_RE.match(sql):
+            result = (await conn.stream(text(sql), params or {})).yield_per(STREAM_BATCH_SIZE)
+            rows = []
+            truncated = False
+            async for r in result:
+                if len(rows) >= MAX_RESULT_ROWS:
+                    truncated = True
+                    break
+                rows.append({k: _coerce(v) for k, v in r._mapping.items()})
+            return {"rows": rows, "truncated": truncated}
 
         # DML query → return affected row count
+        result = await conn.execute(text(sql), params or {})
         return result.rowcount
 
-def init_query_history_table(engine: Engine):
-    query = """
+_HISTORY_DDL = [
+    """
     CREATE TABLE IF NOT EXISTS query_history (
         id SERIAL PRIMARY KEY,
+        request_id TEXT,
         user_id TEXT NOT NULL,
         db_name TEXT NOT NULL,
         user_prompt TEXT NOT NULL,
@@ -69,34 +202,147 @@ def init_query_history_table(engine: Engine):
         result JSONB,
         created_at TIMESTAMP DEFAULT now()
     );
-    """
+    """,
+    # request_id was added after the table first shipped
+    "ALTER TABLE query_history ADD COLUMN IF NOT EXISTS request_id TEXT;",
+]
+
+def init_query_history_table(engine: Engine):
     with engine.begin() as conn:
-        conn.execute(text(query))
-
-def log_query_history(engine: Engine, user_id: str, db_name: str, user_prompt: str, generated_sql: str, result):
-    result_json = json.dumps(result, default=json_serial)
-    query = """
-    INSERT INTO query_history (user_id, db_name, user_prompt, generated_sql, result, created_at)
-    VALUES (:user_id, :db_name, :user_prompt, :generated_sql, CAST(:result AS JSONB), now())
-    RETURNING id, created_at;
-    """
-    params = {
+        for ddl in _HISTORY_DDL:
+            conn.execute(text(ddl))
+
+# DDL guards keyed by URL so each runs once per database. Kept out of
+# the engine factories: the schema-index CLI shares get_engine, and
+# creating query_history as a side effect of connecting would make the
+# indexer sample the app's own history table.
+_sync_history_table_ready: set = set()
+
+def ensure_history_table_sync(engine: Engine):
+    key = str(engine.url)
+    if key in _sync_history_table_ready:
+        return
+    init_query_history_table(engine)
+    _sync_history_table_ready.add(key)
+
+_history_table_ready: set = set()
+
+async def ensure_history_table(engine: AsyncEngine):
+    key = str(engine.url)
+    if key in _history_table_ready:
+        return
+    async with engine.begin() as conn:
+        for ddl in _HISTORY_DDL:
+            await conn.execute(text(ddl))
+    _history_table_ready.add(key)
+
+# ---------------------------------------------------------------
+# Background history writer: /query used to block on a synchronous
+# single-row INSERT before responding. Rows are queued here instead and
+# flushed in batches with one executemany INSERT per database.
+# ---------------------------------------------------------------
+HISTORY_FLUSH_BATCH = 100
+HISTORY_FLUSH_WAIT = 0.5  # seconds to linger for more rows before flushing
+
+# Core Table rather than a textual INSERT: the psycopg2 dialect only
+# batches executemany (execute_values / insertmanyvalues) for compiled
+# Core constructs — a text() statement degrades to one round-trip per
+# row. `result` is typed JSONB so Postgres parses it natively, and
+# created_at is left to the column's now() default.
+_history_table = Table(
+    "query_history", MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("request_id", Text),
+    Column("user_id", Text),
+    Column("db_name", Text),
+    Column("user_prompt", Text),
+    Column("generated_sql", Text),
+    Column("result", JSONB),
+    Column("created_at", DateTime),
+)
+_HISTORY_INSERT = _history_table.insert()
+
+_history_queue: "queue.Queue" = queue.Queue()
+_history_worker_lock = threading.Lock()
+_history_worker_started = False
+
+def queue_query_history(db_name: str, user_id: str, user_prompt: str, generated_sql: str, result, request_id: str = None):
+    """Queue a history row for the background writer (non-blocking)."""
+    _ensure_history_worker()
+    _history_queue.put({
+        "request_id": request_id,
         "user_id": user_id,
         "db_name": db_name,
         "user_prompt": user_prompt,
         "generated_sql": generated_sql,
-        "result": result_json
-    }
-    with engine.begin() as conn:
-        row = conn.execute(text(query), params).fetchone()
-    return {"id": row["id"], "created_at": row["created_at"]}
+        "result": result,
+    })
+
+def start_history_writer():
+    """Start the background history writer eagerly (e.g. at app startup)
+    so the first request doesn't pay for thread creation."""
+    _ensure_history_worker()
+
+def _ensure_history_worker():
+    global _history_worker_started
+    if _history_worker_started:
+        return
+    with _history_worker_lock:
+        if not _history_worker_started:
+            worker = threading.Thread(target=_history_worker, name="history-writer", daemon=True)
+            worker.start()
+            _history_worker_started = True
+
+def _history_worker():
+    while True:
+        batch = [_history_queue.get()]  # block until there's work
+        deadline = time.monotonic() + HISTORY_FLUSH_WAIT
+        while len(batch) < HISTORY_FLUSH_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_history_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _flush_history_batch(batch)
+
+def _flush_history_batch(batch: List[Dict[str, Any]]):
+    # Group by target database, then insert each group with a single
+    # executemany round-trip.
+    by_db: Dict[str, List[Dict[str, Any]]] = {}
+    for row in batch:
+        by_db.setdefault(row["db_name"], []).append(row)
+
+    for db_name, rows in by_db.items():
+        try:
+            engine = get_engine(db_name)
+            ensure_history_table_sync(engine)
+            with engine.begin() as conn:
+                conn.execute(_HISTORY_INSERT, rows)
+        except Exception:
+            logger.exception("Failed to flush %d history rows for '%s'", len(rows), db_name)
+
+@atexit.register
+def _drain_history_queue():
+    # The writer is a daemon thread, so anything still queued at shutdown
+    # would be dropped silently; flush it synchronously like the FAISS
+    # side does.
+    batch = []
+    while True:
+        try:
+            batch.append(_history_queue.get_nowait())
+        except queue.Empty:
+            break
+    if batch:
+        _flush_history_batch(batch)
 
-def fetch_history(engine: Engine, user_id: str, limit: int = 20):
+async def fetch_history(engine: AsyncEngine, user_id: str, limit: int = 20):
+    await ensure_history_table(engine)
     query = text(
-        "SELECT id, user_prompt, generated_sql, result, created_at "
+        "SELECT id, request_id, user_prompt, generated_sql, result, created_at "
         "FROM query_history WHERE user_id = :user_id ORDER BY created_at DESC LIMIT :limit"
     )
-    with engine.connect() as conn:
-        rows = conn.execute(query, {"user_id": user_id, "limit": limit}).fetchall()
-        safe_rows = json.loads(json.dumps([dict(r._mapping) for r in rows], default=json_serial))
-    return safe_rows
+    async with engine.connect() as conn:
+        rows = await conn.execute(query, {"user_id": user_id, "limit": limit})
+        return [{k: _coerce(v) for k, v in r._mapping.items()} for r in rows]
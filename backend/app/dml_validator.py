@@ -2,7 +2,30 @@ import re
 from typing import Dict, Any, List
 from datetime import datetime
 import sqlparse
+from sqlparse.sql import Function, Identifier
+from sqlparse.tokens import Keyword, Name
 
+# Precompiled at import so the hot validation path skips re's cache lookup
+# and flag handling on every call.
+_INSERT_FULL_RE = re.compile(r"INSERT\s+INTO\s+\w+\s*\((.*?)\)\s*VALUES\s*\((.*?)\)", re.IGNORECASE)
+_SET_RE = re.compile(r"SET\s+(.*?)(\s+WHERE|$)", re.IGNORECASE | re.DOTALL)
+_WHERE_RE = re.compile(r"\bWHERE\b", re.IGNORECASE)
+
+# Keyword that precedes the target table for each statement type.
+_TABLE_MARKERS = {"INSERT": "INTO", "UPDATE": "UPDATE", "DELETE": "FROM"}
+
+
+class _TableColumns(dict):
+    """
+    Per-table column metadata. Behaves exactly like the plain dict it
+    replaces, but carries the set of required column names precomputed at
+    normalization time so DML validation doesn't rebuild it per call.
+    """
+    __slots__ = ("required",)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.required = frozenset()
 
 def normalize_schema(raw_schema):
     """
@@ -33,7 +56,7 @@ def normalize_schema(raw_schema):
         if table_name is None:
             continue
         tkey = str(table_name).lower()
-        schema_map.setdefault(tkey, {})
+        schema_map.setdefault(tkey, _TableColumns())
 
         # If `cols` is a dict and contains a `columns` key (schema_index style)
         if isinstance(cols, dict) and "columns" in cols and isinstance(cols["columns"], list):
@@ -73,53 +96,93 @@ def normalize_schema(raw_schema):
                 "required": required
             }
 
+        table_cols = schema_map[tkey]
+        table_cols.required = frozenset(c for c, m in table_cols.items() if m["required"])
+
     return schema_map
 
-def extract_table_name(sql: str, stmt_type: str) -> str:
-    sql = sql.strip()
-    if stmt_type == "INSERT":
-        # matches: INSERT INTO table_name (...)
-        m = re.match(r"INSERT\s+INTO\s+([^\s(]+)", sql, re.IGNORECASE)
-        return m.group(1).lower() if m else None
-    elif stmt_type == "UPDATE":
-        m = re.match(r"UPDATE\s+([^\s(]+)", sql, re.IGNORECASE)
-        return m.group(1).lower() if m else None
-    elif stmt_type == "DELETE":
-        m = re.match(r"DELETE\s+FROM\s+([^\s(]+)", sql, re.IGNORECASE)
-        return m.group(1).lower() if m else None
+def extract_table_name(stmt, stmt_type: str) -> str:
+    """
+    Pull the target table out of an already-parsed sqlparse statement by
+    walking its tokens, so the SQL string isn't re-scanned with regexes
+    after sqlparse has tokenized it once.
+    """
+    marker = _TABLE_MARKERS.get(stmt_type)
+    if not marker:
+        return None
+
+    grab_next = False
+    for tok in stmt.tokens:
+        if tok.is_whitespace:
+            continue
+        if grab_next:
+            # `INSERT INTO t (a, b)` groups the table + column list as a
+            # Function; bare tables come through as Identifier or a Name.
+            if isinstance(tok, (Function, Identifier)):
+                name = tok.get_real_name()
+                return name.lower() if name else None
+            if tok.ttype in (Name, Keyword):
+                return tok.value.strip('"').lower()
+            return None
+        if tok.ttype in (Keyword, Keyword.DML) and tok.value.upper() == marker:
+            grab_next = True
     return None
 
-def cast_value_for_sql(value: str, col_type: str) -> str:
-    """Cast a string value to a properly formatted SQL literal based on column type."""
-    if value.upper() == "NULL":
-        return "NULL"
+# Column types repeat across rows, so classify each distinct type string
+# once and cache the result instead of re-running the substring tests per
+# value.
+_TYPE_CLASS_CACHE: Dict[str, str] = {}
+
+def _classify_type(col_type: str) -> str:
+    upper = col_type.upper()
+    cls = _TYPE_CLASS_CACHE.get(upper)
+    if cls is None:
+        if "INT" in upper:
+            cls = "int"
+        elif "NUMERIC" in upper or "DECIMAL" in upper or "FLOAT" in upper or "DOUBLE" in upper:
+            cls = "float"
+        elif "DATE" in upper:
+            cls = "date"
+        elif "CHAR" in upper or "TEXT" in upper:
+            cls = "text"
+        else:
+            cls = "other"
+        _TYPE_CLASS_CACHE[upper] = cls
+    return cls
 
-    col_type = col_type.upper()
+def cast_value_for_param(value: str, col_type: str):
+    """
+    Convert a string literal to a typed Python value suitable for a bound
+    parameter, so the statement itself stays constant and Postgres can
+    reuse its plan instead of re-planning every unique literal.
+    """
+    if value.upper() == "NULL":
+        return None
 
+    # The literal came out of a quoted SQL string, so doubled quotes are
+    # escapes ('Al''s' means Al's); unescape them or the bound parameter
+    # stores both characters verbatim.
+    stripped = value.strip("'").strip('"').replace("''", "'")
+    cls = _classify_type(col_type)
     try:
-        if "INT" in col_type:
-            return str(int(value))
-        elif "NUMERIC" in col_type or "DECIMAL" in col_type or "FLOAT" in col_type or "DOUBLE" in col_type:
-            return str(float(value))
-        elif "DATE" in col_type:
-            # Convert to ISO date format string
-            dt = datetime.fromisoformat(value.strip("'").strip('"'))
-            return f"'{dt.date().isoformat()}'"
-        elif "CHAR" in col_type or "TEXT" in col_type or "VARCHAR" in col_type:
-            val = value.strip("'").strip('"')
-            return f"'{val}'"
-        else:
-            return value
+        if cls == "int":
+            return int(stripped)
+        if cls == "float":
+            return float(stripped)
+        if cls == "date":
+            return datetime.fromisoformat(stripped).date()
     except Exception:
-        # fallback: quote as string
-        val = value.strip("'").strip('"')
-        return f"'{val}'"
+        pass
+    return stripped
 
 def validate_and_cast_dml(sql: str, schema_map: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
     """
-    Validates a DML SQL statement against a normalized schema,
-    casts values to proper SQL literals, and returns updated SQL.
+    Validates a DML SQL statement against a normalized schema and returns
+    updated SQL with values bound as typed parameters (in "params"),
+    ready for conn.execute(text(sql), params). WHERE clauses are kept
+    verbatim.
     """
+    params = {}
     parsed = sqlparse.parse(sql)
     if not parsed:
         return {"valid": False, "message": "Unable to parse SQL.", "sql": sql}
@@ -129,8 +192,8 @@ def validate_and_cast_dml(sql: str, schema_map: Dict[str, Dict[str, Any]]) -> Di
     if stmt_type not in ("INSERT", "UPDATE", "DELETE"):
         return {"valid": False, "message": "Not a DML query.", "sql": sql}
 
-    # Extract table name
-    table_name = extract_table_name(sql, stmt_type)
+    # Extract table name from the tokens we already parsed
+    table_name = extract_table_name(stmt, stmt_type)
     if not table_name or table_name not in schema_map:
         return {"valid": False, "message": f"Table '{table_name}' not found in schema.", "sql": sql}
 
@@ -139,48 +202,61 @@ def validate_and_cast_dml(sql: str, schema_map: Dict[str, Dict[str, Any]]) -> Di
 
     if stmt_type == "INSERT":
         # Extract columns and values
-        m = re.match(r"INSERT\s+INTO\s+\w+\s*\((.*?)\)\s*VALUES\s*\((.*?)\)", sql, re.IGNORECASE)
+        m = _INSERT_FULL_RE.match(sql)
         if not m:
             return {"valid": False, "message": "INSERT statement parsing failed.", "sql": sql}
 
         cols = [c.strip().lower() for c in m.group(1).split(",")]
         values = [v.strip() for v in m.group(2).split(",")]
 
-        # check missing required
-        for col, meta in table_cols.items():
-            if not meta.get("nullable", True) and col not in cols and meta.get("default") is None:
-                missing_required.append(col)
-
-        # cast values
-        casted_values = []
-        for col, val in zip(cols, values):
-            if col in table_cols:
-                casted_values.append(cast_value_for_sql(val, table_cols[col]["type"]))
+        # check missing required via set membership instead of scanning
+        # the supplied column list once per table column
+        required = getattr(table_cols, "required", None)
+        if required is None:  # schema_map built by hand, not normalize_schema
+            required = {c for c, meta in table_cols.items() if meta.get("required")}
+        supplied = set(cols)
+        missing_required = [c for c in required if c not in supplied]
+
+        # bind values as typed parameters; columns we can't classify keep
+        # their original literal (e.g. expressions like now())
+        value_exprs = []
+        for idx, (col, val) in enumerate(zip(cols, values)):
+            meta = table_cols.get(col)
+            if meta and _classify_type(meta["type"] or "") != "other":
+                key = f"p{idx}"
+                params[key] = cast_value_for_param(val, meta["type"])
+                value_exprs.append(f":{key}")
             else:
-                casted_values.append(val)
+                value_exprs.append(val)
 
         # rebuild SQL
-        new_sql = f"INSERT INTO {table_name} ({', '.join(cols)}) VALUES ({', '.join(casted_values)});"
+        new_sql = f"INSERT INTO {table_name} ({', '.join(cols)}) VALUES ({', '.join(value_exprs)});"
 
     elif stmt_type == "UPDATE":
         # Extract SET clauses
-        set_match = re.search(r"SET\s+(.*?)(\s+WHERE|$)", sql, re.IGNORECASE | re.DOTALL)
+        set_match = _SET_RE.search(sql)
         set_text = set_match.group(1) if set_match else ""
         assignments = [a.strip() for a in set_text.split(",") if a.strip()]
         new_assignments = []
 
-        for a in assignments:
+        for idx, a in enumerate(assignments):
             if "=" in a:
                 col, val = a.split("=", 1)
                 col = col.strip().lower()
                 val = val.strip()
-                if col in table_cols:
-                    val = cast_value_for_sql(val, table_cols[col]["type"])
+                meta = table_cols.get(col)
+                if meta and _classify_type(meta["type"] or "") != "other":
+                    key = f"p{idx}"
+                    params[key] = cast_value_for_param(val, meta["type"])
+                    val = f":{key}"
                 new_assignments.append(f"{col} = {val}")
             else:
                 new_assignments.append(a)
 
-        where_clause = sql[sql.upper().find("WHERE"):] if "WHERE" in sql.upper() else ""
+        # Case-insensitive search from the end of the SET list — no
+        # uppercased copies of the full statement needed
+        where_match = _WHERE_RE.search(sql, set_match.end(1) if set_match else 0)
+        where_clause = sql[where_match.start():] if where_match else ""
         new_sql = f"UPDATE {table_name} SET {', '.join(new_assignments)} {where_clause}"
 
     else:  # DELETE
@@ -193,4 +269,4 @@ def validate_and_cast_dml(sql: str, schema_map: Dict[str, Dict[str, Any]]) -> Di
             "sql": sql
         }
 
-    return {"valid": True, "message": "SQL is valid and values casted.", "sql": new_sql}
\ No newline at end of file
+    return {"valid": True, "message": "SQL is valid and values casted.", "sql": new_sql, "params": params}
\ No newline at end of file
@@ -1,18 +1,41 @@
 # backend/app/langchain_nl2sql.py
+import asyncio
+import atexit
+import functools
+import logging
+import orjson
 import os
+import re
+import threading
+import time
+from collections import deque
+import sqlparse
+from sqlparse.sql import Function, Identifier, IdentifierList, Parenthesis
+from sqlparse.tokens import Keyword, Name
 from langchain.prompts import PromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
 from langchain_core.output_parsers import StrOutputParser
 from langchain_community.vectorstores import FAISS
 
+logger = logging.getLogger(__name__)
+
 # -------------------------------
 # LLM setup
 # -------------------------------
-def get_gemini_llm(model="gemini-2.5-flash"):
+@functools.lru_cache(maxsize=4)
+def get_gemini_llm(model="gemini-2.5-flash", json_output=False):
+    # Memoized: building a ChatGoogleGenerativeAI client per request tears
+    # down and recreates the underlying HTTP session each time.
+    # json_output makes Gemini emit application/json directly, so the SQL
+    # chain's responses don't arrive wrapped in markdown fences at all.
+    kwargs = {}
+    if json_output:
+        kwargs["response_mime_type"] = "application/json"
     return ChatGoogleGenerativeAI(
         model=model,
         temperature=0,
-        google_api_key=os.getenv("GEMINI_API_KEY")
+        google_api_key=os.getenv("GEMINI_API_KEY"),
+        **kwargs
     )
 
 # -------------------------------
@@ -69,8 +92,6 @@ Return **ONLY valid JSON** as shown in the example.
 # -------------------------------
 # Memory: multi-turn short-term + long-term
 # -------------------------------
-memory = {"history": [], "max_history": 10}
-
 embedding_model = GoogleGenerativeAIEmbeddings(
     model="models/gemini-embedding-001",
     google_api_key=os.getenv("GEMINI_API_KEY")
@@ -88,19 +109,204 @@ else:
 memory = {}
 DEFAULT_MAX_HISTORY = 10
 
+@functools.lru_cache(maxsize=1024)
+def _embed_query_cached(query: str):
+    # Each similarity search embeds the query through the Gemini
+    # embedding API (an HTTP call); identical user queries recur often,
+    # so cache the vector per query string.
+    return tuple(embedding_model.embed_query(query))
+
+# New (question, SQL) pairs are buffered and added to FAISS in batches:
+# add_texts + save_local per request serializes the whole index to disk
+# every time. The buffer, flushes, and saves run from request worker
+# threads, the checkpoint thread, and atexit, so they all serialize on
+# one lock (reentrant: _remember_query_text flushes while holding it).
+_vector_lock = threading.RLock()
+_pending_texts = []
+_PENDING_FLUSH_COUNT = 8
+
+# Disk persistence is decoupled from the in-memory index: save_local
+# rewrites the whole index + docstore pickle (O(store size)), so a
+# checkpointer thread saves at most once per interval when dirty, and an
+# atexit hook flushes whatever is left on shutdown.
+_VECTOR_SAVE_INTERVAL = 30.0  # seconds
+_vector_dirty = False
+_vector_saver_lock = threading.Lock()
+_vector_saver_started = False
+
+def _search_similar(user_query: str):
+    return vector_store.similarity_search_with_score_by_vector(
+        list(_embed_query_cached(user_query)), k=2
+    )
+
+def _remember_query_text(text: str):
+    with _vector_lock:
+        _pending_texts.append(text)
+        if len(_pending_texts) >= _PENDING_FLUSH_COUNT:
+            _flush_pending_texts()
+
+def _flush_pending_texts():
+    global vector_store, _vector_dirty
+    with _vector_lock:
+        if not _pending_texts:
+            return
+        if vector_store is None:
+            vector_store = FAISS.from_texts(list(_pending_texts), embedding_model)
+        else:
+            vector_store.add_texts(list(_pending_texts))
+        _pending_texts.clear()
+        _vector_dirty = True
+    _ensure_vector_saver()
+
+def _save_vector_store():
+    global _vector_dirty
+    with _vector_lock:
+        if vector_store is not None and _vector_dirty:
+            vector_store.save_local(vector_store_path)
+            _vector_dirty = False
+
+def _ensure_vector_saver():
+    global _vector_saver_started
+    if _vector_saver_started:
+        return
+    with _vector_saver_lock:
+        if not _vector_saver_started:
+            saver = threading.Thread(target=_vector_saver, name="faiss-checkpoint", daemon=True)
+            saver.start()
+            _vector_saver_started = True
+
+def _vector_saver():
+    while True:
+        time.sleep(_VECTOR_SAVE_INTERVAL)
+        try:
+            _save_vector_store()
+        except Exception:
+            logger.exception("Failed to checkpoint vector store")
+
+@atexit.register
+def _flush_vector_store():
+    # Don't lose buffered pairs or an unsaved index on shutdown
+    try:
+        _flush_pending_texts()
+        _save_vector_store()
+    except Exception:
+        logger.exception("Failed to flush vector store on exit")
+
 # -------------------------------
 # Chain creator
 # -------------------------------
-def create_sql_chain(schema_text: str):
-    llm = get_gemini_llm()
-    output_parser = StrOutputParser()
-    chain = SQL_PROMPT | llm | output_parser
-    return chain
+# The prompt template is static and schema_text is just a runtime input
+# variable, so the chain itself never changes — build it lazily once and
+# hand the same object back on every request.
+_sql_chain = None
+
+def create_sql_chain(schema_text: str = None):
+    global _sql_chain
+    if _sql_chain is None:
+        _sql_chain = SQL_PROMPT | get_gemini_llm(json_output=True) | StrOutputParser()
+    return _sql_chain
 
 # -------------------------------
 # SQL Validation
 # -------------------------------
-def validate_sql_with_schema(sql: str, schema_text: str) -> bool:
+# First-token DML check; matches without lowercasing the whole statement.
+_DML_RE = re.compile(r"^\s*(?:INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+
+# Keywords that are followed by a table reference.
+_TABLE_KEYWORDS = {"FROM", "INTO", "UPDATE", "JOIN", "INNER JOIN", "LEFT JOIN",
+                   "RIGHT JOIN", "FULL JOIN", "LEFT OUTER JOIN", "RIGHT OUTER JOIN",
+                   "FULL OUTER JOIN", "CROSS JOIN"}
+
+def _extract_referenced_tables(sql: str):
+    """
+    Collect the table names a statement references by walking sqlparse
+    tokens. Returns (tables, ambiguous); ambiguous is True when the
+    statement uses constructs we can't resolve locally (derived tables,
+    CTEs, unparseable SQL) and the caller should fall back to the LLM.
+    """
+    try:
+        parsed = sqlparse.parse(sql)
+    except Exception:
+        return set(), True
+    if not parsed:
+        return set(), True
+
+    tables = set()
+    ambiguous = False
+
+    def add_identifier(tok):
+        nonlocal ambiguous
+        # An aliased derived table (`FROM (SELECT ...) sub`) or function
+        # table (`FROM generate_series(...) gs`) parses as an Identifier
+        # wrapping a Parenthesis/Function, and get_real_name() returns
+        # just the alias — which is not a schema table.
+        if isinstance(tok.token_first(skip_cm=True), (Parenthesis, Function)):
+            ambiguous = True
+            return
+        name = tok.get_real_name()
+        if name:
+            tables.add(name.lower())
+        else:
+            ambiguous = True
+
+    def add_table_item(tok, marker):
+        nonlocal ambiguous
+        if isinstance(tok, Function):
+            # `INSERT INTO t (cols)` groups the table + column list as a
+            # Function; after any other keyword a Function is a
+            # set-returning call (generate_series, ...), not a table.
+            if marker == "INTO":
+                add_identifier(tok)
+            else:
+                ambiguous = True
+        elif isinstance(tok, Identifier):
+            add_identifier(tok)
+        elif tok.ttype in (Name, Keyword):
+            tables.add(tok.value.strip('"').lower())
+        else:
+            ambiguous = True
+
+    def walk(token_list):
+        nonlocal ambiguous
+        grab_for = None
+        for tok in token_list.tokens:
+            if tok.is_whitespace:
+                continue
+            # CTE names shadow schema tables; don't guess. WITH tokenizes
+            # as Keyword.CTE, so match the Keyword subtree with `in`.
+            if tok.ttype in Keyword and tok.value.upper() == "WITH":
+                ambiguous = True
+            if grab_for:
+                marker, grab_for = grab_for, None
+                if isinstance(tok, Parenthesis):
+                    ambiguous = True  # derived table
+                elif isinstance(tok, IdentifierList):
+                    for ident in tok.get_identifiers():
+                        add_table_item(ident, marker)
+                else:
+                    add_table_item(tok, marker)
+            if tok.ttype in (Keyword, Keyword.DML) and tok.value.upper() in _TABLE_KEYWORDS:
+                grab_for = tok.value.upper()
+            if tok.is_group:
+                walk(tok)
+
+    for stmt in parsed:
+        walk(stmt)
+    return tables, ambiguous
+
+async def validate_sql_with_schema(sql: str, schema_text: str) -> bool:
+    # Fast path: check table references against the schema locally.
+    # The second Gemini round-trip roughly doubled /query latency just to
+    # get a YES/NO the token walk can answer for straightforward SQL.
+    schema_tables = {
+        line.split(":", 1)[0].strip().lower()
+        for line in schema_text.splitlines() if ":" in line
+    }
+    referenced, ambiguous = _extract_referenced_tables(sql)
+    if referenced and not ambiguous:
+        return all(t in schema_tables for t in referenced)
+
+    # Slow path: aliases/subqueries/CTEs we can't resolve — ask the LLM.
     validator = get_gemini_llm()
     check_prompt = f"""
     Here is a PostgreSQL query:
@@ -112,18 +318,23 @@ def validate_sql_with_schema(sql: str, schema_text: str) -> bool:
     Question: Does this SQL correctly use only columns/tables from the schema,
     follow correct SQL syntax, and align with the request? Answer only 'YES' or 'NO'.
     """
-    response = validator.invoke(check_prompt)
+    response = await validator.ainvoke(check_prompt)
     return "YES" in response.content.strip().upper()
 
 # -------------------------------
 # Run SQL chain
 # -------------------------------
-def run_sql_chain(chain, schema_text, user_query, user_id):
+async def run_sql_chain(chain, schema_text, user_query, user_id):
     global memory, vector_store
 
-    # Ensure per-user session history
+    # Ensure per-user session history; deque(maxlen=...) evicts the oldest
+    # entry on append, so no slice-and-rebind trimming is needed.
+    # "pending" indexes DML entries awaiting confirmation by SQL hash.
     if user_id not in memory:
-        memory[user_id] = {"history": [], "max_history": DEFAULT_MAX_HISTORY}
+        memory[user_id] = {
+            "history": deque(maxlen=DEFAULT_MAX_HISTORY),
+            "pending": {},
+        }
 
     session_history = memory[user_id]["history"]
 
@@ -134,8 +345,12 @@ def run_sql_chain(chain, schema_text, user_query, user_id):
     ]
     context_text = "\n\n".join(context_items)
 
-    # Long-term context
-    docs_and_scores = vector_store.similarity_search_with_score(user_query, k=2) if vector_store else []
+    # Long-term context (query embedding cached per query string). The
+    # embedding call is blocking HTTP, so keep it off the event loop.
+    docs_and_scores = (
+        await asyncio.to_thread(_search_similar, user_query)
+        if vector_store else []
+    )
     if docs_and_scores:
         doc_context, score = docs_and_scores[0]
         context_text += f"\n\n{doc_context.page_content}"
@@ -147,12 +362,11 @@ def run_sql_chain(chain, schema_text, user_query, user_id):
         "schema_text": schema_text,
         "context": context_text
     }
-    generated_text = chain.invoke(gemini_prompt).strip()
+    generated_text = (await chain.ainvoke(gemini_prompt)).strip()
 
     # Parse JSON output
     try:
-        import json
-        result = json.loads(generated_text)
+        result = orjson.loads(generated_text)
         sql = result.get("sql", "")
         suggestions = result.get("suggestions", [])
     except Exception:
@@ -160,16 +374,13 @@ def run_sql_chain(chain, schema_text, user_query, user_id):
         suggestions = []
 
     # Detect DML (INSERT/UPDATE/DELETE)
-    is_dml = sql.strip().lower().startswith(("insert", "update", "delete"))
+    is_dml = bool(_DML_RE.match(sql))
 
     # Validate SQL
-    if validate_sql_with_schema(sql, schema_text):
-        # Update vector store
-        if vector_store is None:
-            vector_store = FAISS.from_texts([f"Q: {user_query}\nSQL: {sql}"], embedding_model)
-        else:
-            vector_store.add_texts([f"Q: {user_query}\nSQL: {sql}"])
-        vector_store.save_local("faiss_sql_index")
+    if await validate_sql_with_schema(sql, schema_text):
+        # Update vector store (batched; flushing embeds via blocking HTTP,
+        # so run it in a worker thread)
+        await asyncio.to_thread(_remember_query_text, f"Q: {user_query}\nSQL: {sql}")
 
         return {
             "sql": sql,
@@ -1,13 +1,21 @@
 # backend/app/main.py
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse, Response
 from pydantic import BaseModel
 from typing import Optional
-from .database import get_engine, get_db_schema, execute_sql, init_query_history_table, log_query_history, fetch_history
+from .database import get_async_engine, get_db_schema, execute_sql, queue_query_history, fetch_history, invalidate_schema_cache, start_history_writer, summarize_result, json_serial
 from .langchain_nl2sql import create_sql_chain, run_sql_chain, memory  # updated imports
 from .dml_validator import validate_and_cast_dml, normalize_schema
-import json
+import hashlib
+import logging
+import orjson
+import re
+from uuid import uuid4
 
-app = FastAPI(title="NL2SQL with LangChain + Gemini + History")
+logger = logging.getLogger(__name__)
+
+# orjson serializes every response; matters most for large result payloads
+app = FastAPI(title="NL2SQL with LangChain + Gemini + History", default_response_class=ORJSONResponse)
 
 
 class QueryRequest(BaseModel):
@@ -21,59 +29,93 @@ class ConfirmRequest(BaseModel):
     sql: str
     confirm: bool
 
+# Formatted views of the raw schema dict. normalize_schema and
+# build_schema_text are deterministic, so they only need to rerun when
+# database.get_db_schema hands back a fresh dict (its TTL cache expired);
+# we detect that by identity of the cached raw schema object.
+_schema_views = {}  # db_name -> (raw_schema, schema_map, schema_text)
+
+def get_schema_views(db_name, raw_schema):
+    cached = _schema_views.get(db_name)
+    if cached and cached[0] is raw_schema:
+        return cached[1], cached[2]
+    schema_map = normalize_schema(raw_schema)
+    schema_text = build_schema_text(schema_map)
+    _schema_views[db_name] = (raw_schema, schema_map, schema_text)
+    return schema_map, schema_text
+
+async def get_cached_schema(db_name: str):
+    """One-stop schema lookup for the endpoints: returns the cached
+    (schema_map, schema_text) pair, refreshing only when the TTL cache in
+    database.get_db_schema expires."""
+    engine = get_async_engine(db_name)
+    raw_schema = await get_db_schema(engine)
+    return get_schema_views(db_name, raw_schema)
+
 def build_schema_text(schema_map):
-    lines = []
-    for table, cols in schema_map.items():
-        col_desc = []
-        for cname, meta in cols.items():
-            req_flag = "required" if meta["required"] else "nullable"
-            typ = meta.get("type") or "UNKNOWN"
-            col_desc.append(f"{cname}({typ}, {req_flag})")
-        lines.append(f"{table}: {', '.join(col_desc)}")
-    return "\n".join(lines)
-
-def clean_sql(sql: str) -> str:
-    """Remove any Markdown code fences from LLM output."""
-    sql = sql.strip()
-    if sql.startswith("```") and sql.endswith("```"):
-        sql = "\n".join(sql.split("\n")[1:-1])
-    return sql.strip()
-
-def clean_llm_output(llm_text: str) -> str:
-    """
-    Remove Markdown code fences and extra whitespace from LLM output.
-    """
+    # Single join over generator expressions: no intermediate lists or
+    # per-column append calls for wide schemas
+    return "\n".join(
+        f"{table}: " + ", ".join(
+            f"{cname}({meta.get('type') or 'UNKNOWN'}, {'required' if meta['required'] else 'nullable'})"
+            for cname, meta in cols.items()
+        )
+        for table, cols in schema_map.items()
+    )
+
+# Matches a fully fenced block (```sql, ```json, bare ```, ...) in one
+# pass, so no splitlines/join allocations per LLM response.
+_FENCE_RE = re.compile(r"^\s*```(?:[A-Za-z0-9_-]*)\s*\n(.*?)\n\s*```\s*$", re.DOTALL)
+
+# Fallback extractor for a JSON object embedded in surrounding prose
+_JSON_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+# Peeks at the first token without uppercasing the whole statement
+_DML_RE = re.compile(r"^\s*(?:INSERT|UPDATE|DELETE|MERGE|UPSERT)\b", re.IGNORECASE)
+
+def strip_fences(llm_text: str) -> str:
+    """Remove Markdown code fences and extra whitespace from LLM output."""
     if not isinstance(llm_text, str):
         return llm_text
-    llm_text = llm_text.strip()
-    if llm_text.startswith("```") and llm_text.endswith("```"):
-        # Remove first and last fence lines
-        lines = llm_text.splitlines()
-        if lines[0].startswith("```"):
-            lines = lines[1:]
-        if lines[-1].strip() == "```":
-            lines = lines[:-1]
-        llm_text = "\n".join(lines)
-    return llm_text.strip()
+    m = _FENCE_RE.match(llm_text)
+    return (m.group(1) if m else llm_text).strip()
+
+def _sql_key(sql: str) -> str:
+    """Stable hash used to index pending-confirmation DML entries."""
+    return hashlib.blake2b(sql.encode(), digest_size=16).hexdigest()
+
+def _push_history(user_mem, entry):
+    """Append to the session history deque, first dropping the evicted
+    entry's hash from the pending index so `pending` stays bounded by the
+    history window (matching the old scan-the-history semantics, where an
+    expired entry could no longer be confirmed)."""
+    history = user_mem["history"]
+    if history.maxlen is not None and len(history) == history.maxlen:
+        evicted = history[0]
+        user_mem.get("pending", {}).pop(_sql_key(evicted["sql"]), None)
+    history.append(entry)
+
+@app.on_event("startup")
+async def startup():
+    # History-table DDL is already guarded to run once per engine; warm
+    # up the background history writer here so no request pays for it.
+    start_history_writer()
 
 @app.get("/")
 def root():
     return {"message": "NL2SQL API (LangChain + Gemini + History)"}
 
 @app.post("/query")
-def run_query(req: QueryRequest):
+async def run_query(req: QueryRequest):
     try:
-        engine = get_engine(req.db_name)
-        init_query_history_table(engine)
-        raw_schema = get_db_schema(engine)
-        schema_map = normalize_schema(raw_schema)
-        schema_text = build_schema_text(schema_map)
+        engine = get_async_engine(req.db_name)
+        schema_map, schema_text = await get_cached_schema(req.db_name)
 
         # Create SQL chain
         chain = create_sql_chain(schema_text)
 
         # Run the chain (LLM may return JSON with SQL + suggestions)
-        result = run_sql_chain(chain, schema_text, req.query, req.user_id)
+        result = await run_sql_chain(chain, schema_text, req.query, req.user_id)
 
         if result.get("clarification_required"):
             return {"message": result["message"], "clarification_required": True}
@@ -81,37 +123,48 @@ def run_query(req: QueryRequest):
         # Run the chain (LLM may return JSON with SQL + suggestions)
         llm_output = result  # raw LLM response
 
-        # Case 1: If "sql" field itself contains JSON (like your example)
+        # Case 1: the "sql" field itself contains JSON. With Gemini now
+        # responding as application/json this is the rare path, so only
+        # attempt the inner parse when the field actually looks like JSON.
         if isinstance(llm_output, dict) and isinstance(llm_output.get("sql"), str):
-            inner_sql = clean_llm_output(llm_output["sql"])
-            try:
-                parsed_inner = json.loads(inner_sql)
-                # Replace "sql" with real SQL
-                llm_output["sql"] = parsed_inner.get("sql", "").strip()
-                llm_output["suggestions"] = parsed_inner.get("suggestions", [])
-            except Exception:
-                llm_output["sql"] = inner_sql.strip()
+            inner_sql = strip_fences(llm_output["sql"])
+            llm_output["sql"] = inner_sql.strip()
+            if inner_sql.lstrip().startswith("{"):
+                try:
+                    m = _JSON_RE.search(inner_sql)
+                    parsed_inner = orjson.loads(m.group(0)) if m else {}
+                    # Replace "sql" with real SQL
+                    llm_output["sql"] = parsed_inner.get("sql", "").strip()
+                    llm_output["suggestions"] = parsed_inner.get("suggestions", [])
+                except Exception:
+                    pass
 
         generated_sql = llm_output.get("sql", "").strip()
         suggestions = llm_output.get("suggestions", [])
         requires_confirmation = llm_output.get("requires_confirmation", False)
 
-        print("Generated SQL:", generated_sql)
-        print("Suggestions:", suggestions)
+        # Lazy %s formatting: nothing is stringified unless DEBUG is on
+        logger.debug("Generated SQL: %s", generated_sql)
+        logger.debug("Suggestions: %s", suggestions)
 
         # Detect DML queries
-        sql_upper = generated_sql.strip().upper()
-        is_dml = sql_upper.startswith(("INSERT", "UPDATE", "DELETE", "MERGE", "UPSERT"))
-        session_history = memory[req.user_id]["history"]
+        is_dml = bool(_DML_RE.match(generated_sql))
 
         if is_dml or requires_confirmation:
-            session_history.append({
+            entry = {
                 "query": req.query,
                 "sql": generated_sql,
                 "suggestions": suggestions,
                 "requires_confirmation": is_dml,
-                "executed": False
-            })
+                "executed": False,
+                # Reference to the schema_map this SQL was generated
+                # against, so /confirm_dml validates against the same
+                # version without re-deriving it.
+                "schema_map": schema_map
+            }
+            _push_history(memory[req.user_id], entry)
+            # Index by SQL hash so /confirm_dml finds it in O(1)
+            memory[req.user_id].setdefault("pending", {})[_sql_key(generated_sql)] = entry
             return {
                 "clarification_required": False,
                 "sql": generated_sql,
@@ -123,47 +176,69 @@ def run_query(req: QueryRequest):
                 "requires_confirmation": True
             }
 
-        # Execute SELECT normally
-        results = execute_sql(engine, generated_sql)
-
-        # Log history
-        hist_row = log_query_history(
-            engine, req.user_id, req.db_name,
-            req.query, generated_sql, results
+        # Execute SELECT normally (streamed, capped at MAX_RESULT_ROWS).
+        # Anything execute_sql doesn't recognize as row-returning comes
+        # back as a bare rowcount instead of the rows/truncated dict.
+        query_result = await execute_sql(engine, generated_sql)
+        if isinstance(query_result, dict):
+            results = query_result["rows"]
+            results_truncated = query_result["truncated"]
+        else:
+            results = query_result
+            results_truncated = False
+
+        # Log history (queued; flushed in batches by a background writer).
+        # Only a summary of the result is stored — the row count plus the
+        # first rows — never the full payload. The id is generated here so
+        # the response isn't gated on the insert; the stored row carries
+        # it as request_id.
+        history_id = uuid4().hex
+        queue_query_history(
+            req.db_name, req.user_id,
+            req.query, generated_sql,
+            summarize_result(results) if isinstance(results, list) else results,
+            request_id=history_id
         )
 
-        session_history.append({
+        _push_history(memory[req.user_id], {
             "query": req.query,
             "sql": generated_sql,
             "suggestions": suggestions,
             "requires_confirmation": is_dml,
             "executed": True
         })
-        if len(session_history) > memory[req.user_id]["max_history"]:
-            memory[req.user_id]["history"] = session_history[-memory[req.user_id]["max_history"]:]
 
-        return {
+        response = {
             "clarification_required": False,
             "sql": generated_sql,
             "results": results,
             "suggestions": suggestions,
-            "history_id": hist_row["id"]
+            "history_id": history_id
         }
+        if results_truncated:
+            response["results_truncated"] = True
+        # Serialize here and return a raw Response: a dict return value
+        # would go through FastAPI's jsonable_encoder, which walks every
+        # row before the response class even sees it.
+        return Response(
+            content=orjson.dumps(response, default=json_serial),
+            media_type="application/json",
+        )
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/confirm_dml")
-def confirm_dml(req: ConfirmRequest):
+async def confirm_dml(req: ConfirmRequest):
     try:
         # Make sure session exists
         if req.user_id not in memory:
             raise HTTPException(status_code=400, detail="No session history found for this user.")
 
-        session_history = memory[req.user_id]["history"]
-
-        # Find the query in history
-        matching = next((item for item in session_history if item["sql"] == req.sql), None)
+        # O(1) lookup in the pending-confirmation index instead of a
+        # linear scan with full string comparisons over session history
+        pending = memory[req.user_id].get("pending", {})
+        matching = pending.get(_sql_key(req.sql))
         if not matching:
             raise HTTPException(status_code=400, detail="SQL not found in session history.")
         if not matching.get("requires_confirmation", False):
@@ -171,35 +246,47 @@ def confirm_dml(req: ConfirmRequest):
         if matching.get("executed", False):
             raise HTTPException(status_code=400, detail="This query has already been executed.")
 
-        # Handle user cancel
+        # Handle user cancel — the entry is no longer confirmable, so
+        # drop it from the pending index too
         if not req.confirm:
+            pending.pop(_sql_key(req.sql), None)
             return {"message": "DML query execution cancelled by user."}
 
-        # Validate before execution
-        engine = get_engine(req.db_name)
-        raw_schema = get_db_schema(engine)
-        schema_map = normalize_schema(raw_schema)
+        # Validate before execution, against the schema_map the SQL was
+        # generated with (stashed in the pending entry by /query); fall
+        # back to the TTL cache for entries that predate it.
+        engine = get_async_engine(req.db_name)
+        schema_map = matching.get("schema_map")
+        if schema_map is None:
+            schema_map, _ = await get_cached_schema(req.db_name)
         validation = validate_and_cast_dml(req.sql, schema_map)
         if not validation["valid"]:
             return {"message": validation["message"]}
 
-        # Execute if valid
-        affected_rows = execute_sql(engine, validation["sql"])
+        # Execute if valid (values travel as bound parameters)
+        affected_rows = await execute_sql(engine, validation["sql"], validation.get("params"))
 
-        # Mark query as executed in session history
+        # Mark query as executed and drop it from the pending index
         matching["executed"] = True
+        pending.pop(_sql_key(req.sql), None)
 
         return {"message": "DML executed successfully", "affected_rows": affected_rows}
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/admin/refresh_schema/{db_name}")
+def refresh_schema(db_name: str):
+    """Invalidate the cached schema for a database (call after DDL)."""
+    invalidate_schema_cache(db_name)
+    _schema_views.pop(db_name, None)
+    return {"message": f"Schema cache invalidated for '{db_name}'."}
+
 @app.get("/history/{user_id}/{db_name}")
-def get_history_api(user_id: str, limit: int = 20, db_name: Optional[str] = None):
+async def get_history_api(user_id: str, limit: int = 20, db_name: Optional[str] = None):
     try:
-        engine = get_engine(db_name)
-        init_query_history_table(engine)
-        rows = fetch_history(engine, user_id, limit=limit)
+        engine = get_async_engine(db_name)
+        rows = await fetch_history(engine, user_id, limit=limit)
         return {"history": rows}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -6,19 +6,29 @@ Usage (run from project root or backend folder):
 PYTHONPATH=backend python3 -m app.scripts.build_schema_index --db nl2sql
 
 It reads DB connection from app.database.get_engine(db_name).
-Outputs: backend/app/data/schema_index_<db_name>.json
+Outputs: backend/app/data/schema_index_<db_name>.json.gz
+(compact gzipped JSON; pass --pretty to also write an indented .json)
 """
 
+import gzip
 import os
-import json
+import orjson
 import argparse
-from sqlalchemy import text
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from sqlalchemy import inspect, text
 from sqlalchemy.exc import SQLAlchemyError
 
 # ensure we can import your app.database
 from app.database import get_engine  # path assumes package `app` is importable
 
 SAMPLE_LIMIT = 5
+# Rows scanned per table by the batched sampling query; larger than
+# SAMPLE_LIMIT to compensate for NULLs in individual columns.
+SAMPLE_SCAN_LIMIT = 50
+# Tables indexed concurrently; each worker holds one pooled connection,
+# well within the engine's pool_size of 20.
+INDEX_WORKERS = 8
 OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
@@ -26,26 +36,132 @@ def safe_str(v):
     """Convert value to string for JSON safely"""
     if v is None:
         return None
+    # Fast path for the types sampling actually returns (columns are cast
+    # to ::text server-side, so this is nearly always already a str);
+    # repr is reserved for values whose __str__ itself raises.
+    if type(v) is str:
+        return v
+    if isinstance(v, (int, float, bool)):
+        return str(v)
     try:
         return str(v)
     except Exception:
         return repr(v)
 
-def build_index_for_db(db_name: str):
+def collect_samples(conn, table: str, col_names):
+    """
+    Sample values for every column of `table` in a single round-trip.
+
+    Primary path (PostgreSQL): one statement of per-column ARRAY
+    subselects, so each column gets its first SAMPLE_LIMIT non-null
+    values with one parse/plan. Falls back to a batched multi-column
+    scan (plus targeted per-column queries for all-NULL columns) on
+    other dialects or if the aggregate query fails.
+    """
+    samples = {c: [] for c in col_names}
+    if not col_names:
+        return samples
+
+    # Identifiers go through the dialect's preparer instead of hand-rolled
+    # f-string double quotes, so names containing quotes or other special
+    # characters are escaped correctly.
+    quote = conn.dialect.identifier_preparer.quote
+    qtable = quote(table)
+
+    selects = ", ".join(
+        f'ARRAY(SELECT {quote(c)}::text FROM {qtable} WHERE {quote(c)} IS NOT NULL LIMIT :lim) AS {quote(c)}'
+        for c in col_names
+    )
+    try:
+        row = conn.execute(text(f"SELECT {selects}"), {"lim": SAMPLE_LIMIT}).fetchone()
+    except Exception:
+        # the failed statement aborts the implicit transaction; roll it
+        # back or every fallback query below errors out too
+        conn.rollback()
+        row = None
+    if row is not None:
+        for c, vals in zip(col_names, row):
+            samples[c] = [safe_str(v) for v in (vals or [])]
+        return samples
+
+    cols_sql = ", ".join(quote(c) for c in col_names)
+    batch_failed = False
+    try:
+        q = text(f'SELECT {cols_sql} FROM {qtable} LIMIT :lim')
+        rows = conn.execute(q, {"lim": SAMPLE_SCAN_LIMIT}).fetchall()
+    except Exception:
+        conn.rollback()
+        rows = []
+        batch_failed = True
+
+    for i, c in enumerate(col_names):
+        vals = [safe_str(r[i]) for r in rows if r[i] is not None][:SAMPLE_LIMIT]
+        if not vals and (rows or batch_failed):
+            try:
+                q = text(f'SELECT {quote(c)} FROM {qtable} WHERE {quote(c)} IS NOT NULL LIMIT :lim')
+                vals = [safe_str(r[0]) for r in conn.execute(q, {"lim": SAMPLE_LIMIT}).fetchall()]
+            except Exception:
+                conn.rollback()
+                vals = []
+        samples[c] = vals
+    return samples
+
+def load_schema_index(path: str):
+    """Read a schema index written by this script (.json.gz or plain .json)."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if path.endswith(".gz"):
+        data = gzip.decompress(data)
+    return orjson.loads(data)
+
+def build_index_for_db(db_name: str, pretty: bool = False):
     engine = get_engine(db_name)
+    schema_index = {"db_name": db_name, "tables": {}, "table_docs": [], "column_docs": []}
+
     try:
-        from sqlalchemy import inspect
-        inspector = inspect(engine)
+        with engine.connect() as conn:
+            tables = inspect(conn).get_table_names()
     except Exception as e:
         raise RuntimeError(f"Failed to inspect engine: {e}")
+    print(f"Found {len(tables)} tables in database '{db_name}'")
 
-    schema_index = {"db_name": db_name, "tables": {}, "table_docs": [], "column_docs": []}
+    # Per-table introspection + sampling is network-bound, so index
+    # tables concurrently; each worker checks out its own pooled
+    # connection. executor.map preserves table order, and merging happens
+    # here in the main thread so schema_index is never written
+    # concurrently.
+    with ThreadPoolExecutor(max_workers=INDEX_WORKERS) as executor:
+        for result in executor.map(partial(index_one_table, engine), tables):
+            if result is None:
+                continue
+            table, table_meta, table_doc, col_docs = result
+            schema_index["tables"][table] = table_meta
+            schema_index["table_docs"].append(table_doc)
+            schema_index["column_docs"].extend(col_docs)
+
+    # write compact gzipped JSON — far smaller and faster to re-read than
+    # the old pretty-printed file; load with load_schema_index()
+    out_path = os.path.abspath(os.path.join(OUTPUT_DIR, f"schema_index_{db_name}.json.gz"))
+    with open(out_path, "wb") as f:
+        f.write(gzip.compress(orjson.dumps(schema_index), compresslevel=6))
+    print(f"Wrote schema index to: {out_path}")
 
-    tables = inspector.get_table_names()
-    print(f"Found {len(tables)} tables in database '{db_name}'")
+    if pretty:
+        debug_path = os.path.abspath(os.path.join(OUTPUT_DIR, f"schema_index_{db_name}.json"))
+        with open(debug_path, "wb") as f:
+            f.write(orjson.dumps(schema_index, option=orjson.OPT_INDENT_2))
+        print(f"Wrote debug schema index to: {debug_path}")
+    return out_path
 
-    for table in tables:
-        try:
+def index_one_table(engine, table):
+    """
+    Worker for one table: introspect, sample, and build its docs on a
+    dedicated pooled connection. Returns (table, table_meta, table_doc,
+    col_docs), or None if the table had to be skipped.
+    """
+    try:
+        with engine.connect() as conn:
+            inspector = inspect(conn)
             cols = inspector.get_columns(table)
             pk = inspector.get_pk_constraint(table).get("constrained_columns", []) if inspector.get_pk_constraint(table) else []
             fks_raw = inspector.get_foreign_keys(table)
@@ -66,63 +182,51 @@ def build_index_for_db(db_name: str):
                     "default": safe_str(c.get("default")),
                 })
 
-            schema_index["tables"][table] = {
+            table_meta = {
                 "columns": columns_clean,
                 "primary_key": pk,
                 "foreign_keys": fks
             }
 
-            # sample values per column (limit SAMPLE_LIMIT)
-            samples = {}
-            with engine.connect() as conn:
-                for c in [col["name"] for col in cols]:
-                    try:
-                        q = text(f'SELECT "{c}" FROM "{table}" WHERE "{c}" IS NOT NULL LIMIT :lim')
-                        rows = conn.execute(q, {"lim": SAMPLE_LIMIT}).fetchall()
-                        vals = [safe_str(r[0]) for r in rows]
-                    except Exception:
-                        vals = []
-                    samples[c] = vals
-
-            # Build table-level doc
-            col_summaries = []
-            for c in columns_clean:
-                col_name = c["name"]
-                dtype = c["type"]
-                sample_vals = samples.get(col_name, [])[:5]
-                sample_str = ", ".join([v for v in sample_vals if v is not None]) if sample_vals else ""
-                col_summaries.append(f"{col_name} ({dtype})" + (f" — examples: {sample_str}" if sample_str else ""))
-
-            pk_str = ", ".join(pk) if pk else "None"
-            fk_str = "; ".join([f'{", ".join(fk["constrained_columns"])} -> {fk["referred_table"]}({", ".join(fk["referred_columns"])})' for fk in fks]) if fks else "None"
-
-            table_doc_text = f"Table {table}: columns: " + "; ".join(col_summaries) + f". Primary key: {pk_str}. Foreign keys: {fk_str}."
-            schema_index["table_docs"].append({"table": table, "text": table_doc_text})
-
-            # column-level docs
-            for c in columns_clean:
-                col_name = c["name"]
-                dtype = c["type"]
-                samples_text = ", ".join([v for v in samples.get(col_name, []) if v is not None])[:200]
-                col_doc_text = f"Column {table}.{col_name} ({dtype}). Examples: {samples_text}."
-                schema_index["column_docs"].append({"table": table, "column": col_name, "text": col_doc_text})
-
-            print(f"Indexed table: {table} cols: {len(cols)} pk: {pk_str} fk_count: {len(fks)}")
-
-        except SQLAlchemyError as e:
-            print(f"Skipping table {table} due to SQLAlchemy error: {e}")
-        except Exception as e:
-            print(f"Unexpected error for table {table}: {e}")
-
-    # write to file
-    out_path = os.path.abspath(os.path.join(OUTPUT_DIR, f"schema_index_{db_name}.json"))
-    with open(out_path, "w", encoding="utf-8") as f:
-        json.dump(schema_index, f, indent=2, ensure_ascii=False)
-    print(f"Wrote schema index to: {out_path}")
-    return out_path
+            # sample values per column (limit SAMPLE_LIMIT), one query per table
+            samples = collect_samples(conn, table, [col["name"] for col in cols])
+
+        # Build table-level doc
+        col_summaries = []
+        for c in columns_clean:
+            col_name = c["name"]
+            dtype = c["type"]
+            sample_vals = samples.get(col_name, [])[:5]
+            sample_str = ", ".join([v for v in sample_vals if v is not None]) if sample_vals else ""
+            col_summaries.append(f"{col_name} ({dtype})" + (f" — examples: {sample_str}" if sample_str else ""))
+
+        pk_str = ", ".join(pk) if pk else "None"
+        fk_str = "; ".join([f'{", ".join(fk["constrained_columns"])} -> {fk["referred_table"]}({", ".join(fk["referred_columns"])})' for fk in fks]) if fks else "None"
+
+        table_doc_text = f"Table {table}: columns: " + "; ".join(col_summaries) + f". Primary key: {pk_str}. Foreign keys: {fk_str}."
+        table_doc = {"table": table, "text": table_doc_text}
+
+        # column-level docs
+        col_docs = []
+        for c in columns_clean:
+            col_name = c["name"]
+            dtype = c["type"]
+            samples_text = ", ".join([v for v in samples.get(col_name, []) if v is not None])[:200]
+            col_doc_text = f"Column {table}.{col_name} ({dtype}). Examples: {samples_text}."
+            col_docs.append({"table": table, "column": col_name, "text": col_doc_text})
+
+        print(f"Indexed table: {table} cols: {len(cols)} pk: {pk_str} fk_count: {len(fks)}")
+        return table, table_meta, table_doc, col_docs
+
+    except SQLAlchemyError as e:
+        print(f"Skipping table {table} due to SQLAlchemy error: {e}")
+    except Exception as e:
+        print(f"Unexpected error for table {table}: {e}")
+    return None
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--db", required=True, help="Database name (as used in get_engine)")
+    parser.add_argument("--pretty", action="store_true", help="Also write an indented JSON file for debugging")
     args = parser.parse_args()
-    build_index_for_db(args.db)
+    build_index_for_db(args.db, pretty=args.pretty)